@@ -336,7 +336,7 @@ class WalletManager(BaseApp):
         keys = w.get_key_dicts(self.network)
         for k in keys:
             k["mine"] = self.keystore.owns(k["key"])
-        if not any([k["mine"] for k in keys]):
+        if not any(k["mine"] for k in keys):
             if not await show_screen(
                     Prompt("Warning!",
                            "None of the keys belong to the device.\n\n"
@@ -511,8 +511,8 @@ class WalletManager(BaseApp):
         amounts = []
 
         # calculate fee
-        fee = sum([psbt.utxo(i).value for i in range(len(psbt.inputs))])
-        fee -= sum([out.value for out in psbt.tx.vout])
+        fee = sum(psbt.utxo(i).value for i in range(len(psbt.inputs)))
+        fee -= sum(out.value for out in psbt.tx.vout)
 
         # metadata for GUI
         meta = {
@@ -1,6 +1,9 @@
 from app import AppError
-from platform import maybe_mkdir, delete_recursively
-import json
+from platform import maybe_mkdir, delete_recursively, file_exists
+try:
+    import ujson as json
+except ImportError:
+    import json
 from bitcoin import ec, hashes, script
 from bitcoin.networks import NETWORKS
 from bitcoin.psbt import DerivationPath
@@ -8,15 +11,46 @@ from bitcoin.descriptor import Descriptor
 from bitcoin.descriptor.arguments import AllowedDerivation
 from bitcoin.transaction import SIGHASH
 import hashlib
+import struct
 from .screens import WalletScreen, WalletInfoScreen
 from .commands import DELETE, EDIT, MENU, INFO
 from gui.screens import Menu
 import lvgl as lv
 
+# wallet menu labels
+EDIT_LABEL = lv.SYMBOL.EDIT + " Change the name"
+DELETE_LABEL = lv.SYMBOL.TRASH + " Delete wallet"
+
 class WalletError(AppError):
     NAME = "Wallet error"
 
 
+class FIFOCache:
+    """
+    Small dict-like cache with limited size.
+    Removes the oldest entry when it is full.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self._data = {}
+        # insertion order, dicts are not ordered in micropython
+        self._order = []
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key not in self._data:
+            if len(self._order) >= self.size:
+                self._data.pop(self._order.pop(0))
+            self._order.append(key)
+        self._data[key] = value
+
+
 class Wallet:
     """
     Wallet class,
@@ -25,6 +59,8 @@ class Wallet:
     """
 
     GAP_LIMIT = 20
+    # number of derived script_pubkeys to keep in memory
+    CACHE_SIZE = 16
 
     def __init__(self, desc, path=None, name="Untitled"):
         self.name = name
@@ -32,6 +68,8 @@ class Wallet:
         if self.path is not None:
             self.path = self.path.rstrip("/")
             maybe_mkdir(self.path)
+        # derived script_pubkeys, key is (branch_idx, idx)
+        self._spk_cache = FIFOCache(self.CACHE_SIZE)
         self.descriptor = desc
         # receive and change gap limits
         self.gaps = [self.GAP_LIMIT for b in range(self.descriptor.num_branches)]
@@ -39,17 +77,62 @@ class Wallet:
         self.unused_recv = 0
         self.keystore = None
 
+    @property
+    def descriptor(self):
+        return self._descriptor
+
+    @descriptor.setter
+    def descriptor(self, desc):
+        self._descriptor = desc
+        # cached values derived from the descriptor
+        self._desc_str = None
+        self._fingerprint = None
+        self._key_fingerprints = None
+        self._keys_by_fp = None
+        self._watchonly = None
+        # keys don't change after the descriptor is set
+        self._keys = tuple(desc.keys)
+        # descriptor flags used by properties below
+        self._has_priv = any(k.is_private for k in self._keys)
+        self._is_miniscript = not (desc.is_basic_multisig or desc.is_pkh)
+        self._is_segwit = desc.is_segwit
+        self._is_wrapped = desc.is_wrapped
+        # get XYZ-pubs
+        self._slip132_ver = "xpub"
+        if desc.is_pkh:
+            if self._is_wrapped:
+                self._slip132_ver = "ypub"
+            elif self._is_segwit:
+                self._slip132_ver = "zpub"
+        elif desc.is_basic_multisig:
+            if self._is_wrapped:
+                self._slip132_ver = "Ypub"
+            elif self._is_segwit:
+                self._slip132_ver = "Zpub"
+        self._spk_type = desc.scriptpubkey_type()
+        self._script_len = desc.script_len
+        # branch HD nodes, key is branch_idx
+        self._branch_nodes = {}
+        self._spk_cache.clear()
+
+    @property
+    def descriptor_str(self):
+        """Cached string representation of the descriptor"""
+        if self._desc_str is None:
+            self._desc_str = str(self.descriptor)
+        return self._desc_str
+
     async def show(self, network, show_screen):
+        buttons = [
+            (INFO, "Show detailed information"),
+            (EDIT, EDIT_LABEL),
+            # value, label,       enabled, color
+            (DELETE, DELETE_LABEL, True, 0x951E2D),
+        ]
         while True:
             scr = WalletScreen(self, network, idx=self.unused_recv)
             cmd = await show_screen(scr)
             if cmd == MENU:
-                buttons = [
-                    (INFO, "Show detailed information"),
-                    (EDIT, lv.SYMBOL.EDIT + " Change the name"),
-                    # value, label,                            enabled, color
-                    (DELETE, lv.SYMBOL.TRASH + " Delete wallet", True, 0x951E2D),
-                ]
                 cmd = await show_screen(Menu(buttons, last=(255, None), title=self.name, note="What do you want to do?"))
                 if cmd == 255:
                     continue
@@ -65,25 +148,38 @@ class Wallet:
     @property
     def is_watchonly(self):
         """Checks if the wallet is watch-only (doesn't control the key) or not"""
-        return not (
-            any([self.keystore.owns(k) if self.keystore else False for k in self.keys])
-            or
-            any([k.is_private for k in self.descriptor.keys])
-        )
+        if self._watchonly is None:
+            self._watchonly = not (
+                (self.keystore is not None and any(self.keystore.owns(k) for k in self.keys))
+                or
+                any(k.is_private for k in self.keys)
+            )
+        return self._watchonly
 
     def save(self, keystore, path=None):
         # wallet has access to keystore only if it's saved or loaded from file
         self.keystore = keystore
+        # keystore may be different now
+        self._watchonly = None
         if path is not None:
             self.path = path.rstrip("/")
         if self.path is None:
             raise WalletError("Path is not defined")
         maybe_mkdir(self.path)
-        desc = str(self.descriptor)
-        keystore.save_aead(self.path + "/descriptor", plaintext=desc.encode())
+        desc = self.descriptor_str.encode()
         obj = {"gaps": self.gaps, "name": self.name, "unused_recv": self.unused_recv}
         meta = json.dumps(obj).encode()
+        # descriptor and meta are stored in a single record:
+        # <desc_len:uint32 LE><descriptor><meta json>
+        blob = struct.pack("<I", len(desc)) + desc + meta
+        keystore.save_aead(self.path + "/wallet", plaintext=blob)
+        # meta record is written by every firmware version on every save,
+        # so it's the source of truth for meta after up- or downgrades
         keystore.save_aead(self.path + "/meta", plaintext=meta)
+        # older firmware also needs the descriptor record,
+        # descriptor never changes so it's written only once
+        if not file_exists(self.path + "/descriptor"):
+            keystore.save_aead(self.path + "/descriptor", plaintext=desc)
 
     def check_network(self, network):
         """
@@ -108,130 +204,245 @@ class Wallet:
         sc, gap = self.script_pubkey([int(branch_index), idx])
         return sc.address(NETWORKS[network]), gap
 
-    def script_pubkey(self, derivation: list):
-        """Returns script_pubkey and gap limit"""
-        # derivation can be only two elements
-        branch_idx, idx = derivation
+    def get_addresses(self, start: int, count: int, network: str, branch_index=0):
+        """Returns a list of count addresses starting from start index and gap limit"""
+        branch_index = int(branch_index)
+        # validate the whole range once
+        self._check_derivation(branch_index, start)
+        if count <= 0:
+            return [], self.gaps[branch_index]
+        self._check_derivation(branch_index, start + count - 1)
+        net = NETWORKS[network]
+        # not cached - the window is usually larger than the cache
+        addresses = [
+            self._derive(branch_index, idx).address(net)
+            for idx in range(start, start + count)
+        ]
+        return addresses, self.gaps[branch_index]
+
+    def _check_derivation(self, branch_idx, idx):
         if branch_idx < 0 or branch_idx >= self.descriptor.num_branches:
             raise WalletError("Invalid branch index %d - can be between 0 and %d" % (branch_idx, self.descriptor.num_branches))
         if idx < 0 or idx >= 0x80000000:
             raise WalletError("Invalid index %d" % idx)
-        sc = self.descriptor.derive(idx, branch_index=branch_idx).script_pubkey()
-        return sc, self.gaps[branch_idx]
+
+    def _derive_script_pubkey(self, branch_idx, idx):
+        """Derives script_pubkey or gets it from the cache"""
+        sc = self._spk_cache.get((branch_idx, idx))
+        if sc is None:
+            sc = self._derive(branch_idx, idx)
+            self._spk_cache[(branch_idx, idx)] = sc
+        return sc
+
+    def _derive(self, branch_idx, idx):
+        """Derives script_pubkey from the branch node if possible"""
+        node = self._branch_node(branch_idx)
+        if node is None:
+            return self.descriptor.derive(idx, branch_index=branch_idx).script_pubkey()
+        return self._leaf_script_pubkey(node, idx)
+
+    def _branch_node(self, branch_idx):
+        """
+        Returns HD node of the branch so only leaf derivation
+        is required for every address. None if not supported.
+        """
+        if branch_idx not in self._branch_nodes:
+            self._branch_nodes[branch_idx] = self._get_branch_node(branch_idx)
+        return self._branch_nodes[branch_idx]
+
+    def _get_branch_node(self, branch_idx):
+        # only single-key wallets with extended keys,
+        # multisig and miniscript derive the whole descriptor
+        if not self.descriptor.is_pkh:
+            return None
+        k = self.keys[0]
+        if not k.is_extended or k.allowed_derivation is None:
+            return None
+        first = k.allowed_derivation.fill(0, branch_index=branch_idx)
+        second = k.allowed_derivation.fill(1, branch_index=branch_idx)
+        # leaf index should be the last one and non-hardened
+        if first[:-1] != second[:-1] or first[-1] != 0 or second[-1] != 1:
+            return None
+        node = k.key.derive(first[:-1])
+        if k.is_private:
+            node = node.to_public()
+        # make sure we get the same script as the descriptor
+        sc = self.descriptor.derive(0, branch_index=branch_idx).script_pubkey()
+        if self._leaf_script_pubkey(node, 0) != sc:
+            return None
+        return node
+
+    def _leaf_script_pubkey(self, node, idx):
+        pub = node.child(idx)
+        if self._is_wrapped:
+            return script.p2sh(script.p2wpkh(pub))
+        if self._is_segwit:
+            return script.p2wpkh(pub)
+        return script.p2pkh(pub)
+
+    def script_pubkey(self, derivation: list):
+        """Returns script_pubkey and gap limit"""
+        # derivation can be only two elements
+        branch_idx, idx = derivation
+        self._check_derivation(branch_idx, idx)
+        return self._derive_script_pubkey(branch_idx, idx), self.gaps[branch_idx]
 
     @property
     def fingerprint(self):
         """Fingerprint of the wallet - hash160(descriptor)"""
-        return hashes.hash160(str(self.descriptor))[:4]
+        if self._fingerprint is None:
+            self._fingerprint = hashes.hash160(self.descriptor_str)[:4]
+        return self._fingerprint
+
+    @property
+    def key_fingerprints(self):
+        """
+        Set of fingerprints that can appear in derivation paths of our keys:
+        fingerprints from key origins and fingerprints of the xpubs themselves.
+        """
+        if self._key_fingerprints is None:
+            fingerprints = set()
+            for k in self.keys:
+                if k.fingerprint is not None:
+                    fingerprints.add(k.fingerprint)
+                if k.is_extended:
+                    fingerprints.add(hashes.hash160(k.get_public_key().sec())[:4])
+            self._key_fingerprints = fingerprints
+        return self._key_fingerprints
+
+    @property
+    def keys_by_fingerprint(self):
+        """Dict mapping origin fingerprint to the list of keys"""
+        if self._keys_by_fp is None:
+            keys_by_fp = {}
+            for k in self.keys:
+                keys_by_fp.setdefault(k.fingerprint, []).append(k)
+            self._keys_by_fp = keys_by_fp
+        return self._keys_by_fp
 
     def owns(self, tx_out, bip32_derivations, script=None):
         """
         Checks that psbt scope belongs to the wallet.
         """
-        # quick check for the scriptpubkey type
-        if tx_out.script_pubkey.script_type() != self.descriptor.scriptpubkey_type():
-            return False
-        # quick check of the script length
-        if script and (len(script.data) != self.descriptor.script_len):
-            return False
-        derivation = self.get_derivation(bip32_derivations)
+        return self._match(tx_out, bip32_derivations, script) is not None
 
+    def _match(self, tx_out, bip32_derivations, script=None):
+        """
+        Returns derivation (branch_idx, idx) of the psbt scope
+        if it belongs to the wallet, None otherwise.
+        """
+        # check derivation first - cheap for scopes of other wallets
+        derivation = self.get_derivation(bip32_derivations)
         # derivation not found
         if derivation is None:
-            return False
+            return None
+        # quick check for the scriptpubkey type
+        if tx_out.script_pubkey.script_type() != self._spk_type:
+            return None
+        # quick check of the script length
+        if script and (len(script.data) != self._script_len):
+            return None
         # check that script_pubkey matches
         sc, _ = self.script_pubkey(derivation)
-        return sc == tx_out.script_pubkey
+        if sc != tx_out.script_pubkey:
+            return None
+        return derivation
 
     def get_derivation(self, bip32_derivations):
+        fingerprints = self.key_fingerprints
         # otherwise we need standard derivation
         for pub in bip32_derivations:
-            if len(bip32_derivations[pub].derivation) >= 2:
-                der = self.descriptor.check_derivation(bip32_derivations[pub])
-                if der is not None:
-                    return der
+            der = bip32_derivations[pub]
+            # skip derivations that don't belong to any of our keys
+            if der.fingerprint not in fingerprints:
+                continue
+            if len(der.derivation) >= 2:
+                res = self.descriptor.check_derivation(der)
+                if res is not None:
+                    return res
 
     def update_gaps(self, psbt=None, known_idxs=None):
-        gaps = self.gaps
         # update from psbt
         if psbt is not None:
-            scopes = []
             for i, inp in enumerate(psbt.inputs):
-                if self.owns(psbt.utxo(i), inp.bip32_derivations, inp.witness_script or inp.redeem_script):
-                    scopes.append(inp)
+                self._update_gap(self._match(psbt.utxo(i), inp.bip32_derivations, inp.witness_script or inp.redeem_script))
             for i, out in enumerate(psbt.outputs):
-                if self.owns(psbt.tx.vout[i], out.bip32_derivations, out.witness_script or out.redeem_script):
-                    scopes.append(out)
-            for scope in scopes:
-                res = self.get_derivation(scope.bip32_derivations)
-                if res is not None:
-                    branch_idx, idx = res
-                    if idx + self.GAP_LIMIT > gaps[branch_idx]:
-                        gaps[branch_idx] = idx + self.GAP_LIMIT + 1
+                self._update_gap(self._match(psbt.tx.vout[i], out.bip32_derivations, out.witness_script or out.redeem_script))
         # update from gaps arg
         if known_idxs is not None:
-            for i, gap in enumerate(gaps):
-                if known_idxs[i] is not None and known_idxs[i] + self.GAP_LIMIT > gap:
-                    gaps[i] = known_idxs[i] + self.GAP_LIMIT
-        self.unused_recv = gaps[0] - self.GAP_LIMIT
-        self.gaps = gaps
+            for i in range(len(self.gaps)):
+                if known_idxs[i] is not None and known_idxs[i] + self.GAP_LIMIT > self.gaps[i]:
+                    self.gaps[i] = known_idxs[i] + self.GAP_LIMIT
+        self.unused_recv = self.gaps[0] - self.GAP_LIMIT
+
+    def _update_gap(self, derivation):
+        """Moves gap limit of the branch if index is close to it"""
+        if derivation is None:
+            return
+        branch_idx, idx = derivation
+        if idx + self.GAP_LIMIT > self.gaps[branch_idx]:
+            self.gaps[branch_idx] = idx + self.GAP_LIMIT + 1
 
     def fill_psbt(self, psbt, fingerprint):
         """Fills derivation paths in inputs"""
+        wallet_key = b"\xfc\xca\x01" + self.fingerprint
+        is_sh = self.descriptor.sh
+        # witness and redeem scripts for derivations we've already seen
+        cache = {}
         for scope in psbt.inputs:
             # fill derivation paths
-            wallet_key = b"\xfc\xca\x01" + self.fingerprint
             if wallet_key not in scope.unknown:
                 continue
             der = scope.unknown[wallet_key]
-            wallet_derivation = []
-            for i in range(len(der) // 4):
-                idx = int.from_bytes(der[4 * i : 4 * i + 4], "little")
-                wallet_derivation.append(idx)
+            # derivation is a sequence of 4-byte little-endian indexes
+            num = len(der) // 4
+            wallet_derivation = list(struct.unpack("<%dI" % num, der[: 4 * num]))
             # find keys with our fingerprint
-            for key in self.descriptor.keys:
-                if key.fingerprint == fingerprint:
-                    pub = key.derive(wallet_derivation).get_public_key()
-                    # fill our derivations
-                    scope.bip32_derivations[pub] = DerivationPath(
-                        fingerprint, key.derivation + wallet_derivation
-                    )
+            for key in self.keys_by_fingerprint.get(fingerprint, ()):
+                pub = key.derive(wallet_derivation).get_public_key()
+                # fill our derivations
+                scope.bip32_derivations[pub] = DerivationPath(
+                    fingerprint, key.derivation + wallet_derivation
+                )
             # fill script
-            scope.witness_script = self.descriptor.derive(*wallet_derivation).witness_script()
-            if self.descriptor.sh:
-                scope.redeem_script = self.descriptor.derive(*wallet_derivation).redeem_script()
+            scripts = cache.get(tuple(wallet_derivation))
+            if scripts is None:
+                # derive descriptor once for both scripts
+                derived = self.descriptor.derive(*wallet_derivation)
+                witness_script = derived.witness_script()
+                redeem_script = derived.redeem_script() if is_sh else None
+                scripts = (witness_script, redeem_script)
+                cache[tuple(wallet_derivation)] = scripts
+            scope.witness_script = scripts[0]
+            if scripts[1] is not None:
+                scope.redeem_script = scripts[1]
 
     @property
     def keys(self):
-        return self.descriptor.keys
+        return self._keys
 
     @property
     def has_private_keys(self):
-        return any([k.is_private for k in self.keys])
+        return self._has_priv
 
     def get_key_dicts(self, network):
         keys = [{
             "key": k,
         } for k in self.keys]
-        # get XYZ-pubs
-        slip132_ver = "xpub"
         canonical_ver = "xpub"
-        if self.descriptor.is_pkh:
-            if self.descriptor.is_wrapped:
-                slip132_ver = "ypub"
-            elif self.descriptor.is_segwit:
-                slip132_ver = "zpub"
-        elif self.descriptor.is_basic_multisig:
-            if self.descriptor.is_wrapped:
-                slip132_ver = "Ypub"
-            elif self.descriptor.is_segwit:
-                slip132_ver = "Zpub"
+        net = NETWORKS[network]
+        slip_pub = net[self._slip132_ver]
+        slip_prv = net[self._slip132_ver.replace("pub", "prv")]
+        canon_pub = net[canonical_ver]
+        canon_prv = net[canonical_ver.replace("pub", "prv")]
         for k in keys:
             k["is_private"] = k["key"].is_private
-            ver = slip132_ver.replace("pub", "prv") if k["is_private"] else slip132_ver
-            k["slip132"] = k["key"].to_string(NETWORKS[network][ver])
-            ver = canonical_ver.replace("pub", "prv") if k["is_private"] else canonical_ver
-            k["canonical"] = k["key"].to_string(NETWORKS[network][ver])
+            if k["is_private"]:
+                k["slip132"] = k["key"].to_string(slip_prv)
+                k["canonical"] = k["key"].to_string(canon_prv)
+            else:
+                k["slip132"] = k["key"].to_string(slip_pub)
+                k["canonical"] = k["key"].to_string(canon_pub)
         return keys
 
     def sign_psbt(self, psbt, sighash=SIGHASH.ALL):
@@ -239,16 +450,21 @@ class Wallet:
             return
         # psbt may not have derivation for other keys
         # and in case of WIF key there is no derivation whatsoever
+        # private keys for derivations we've already seen
+        # as inputs often reuse the same address
+        cache = {}
         for i, inp in enumerate(psbt.inputs):
             der = self.get_derivation(inp.bip32_derivations)
             if der is None:
                 continue
             branch, idx = der
-            derived = self.descriptor.derive(idx, branch_index=branch)
-            keys = [k for k in derived.keys if k.is_private]
+            keys = cache.get((branch, idx))
+            if keys is None:
+                derived = self.descriptor.derive(idx, branch_index=branch)
+                keys = [k for k in derived.keys if k.is_private]
+                cache[(branch, idx)] = keys
             for k in keys:
-                if k.is_private:
-                    psbt.sign_with(k.private_key, sighash)
+                psbt.sign_with(k.private_key, sighash)
 
     @classmethod
     def parse(cls, desc, path=None):
@@ -262,9 +478,12 @@ class Wallet:
     @classmethod
     def from_descriptor(cls, desc:str, path):
         # remove checksum if it's there and all spaces
-        desc = desc.split("#")[0].replace(" ", "")
+        if "#" in desc:
+            desc = desc.split("#", 1)[0]
+        if " " in desc:
+            desc = desc.replace(" ", "")
         descriptor = Descriptor.from_string(desc)
-        no_derivation = all([k.is_extended and k.allowed_derivation is None for k in descriptor.keys])
+        no_derivation = all(k.is_extended and k.allowed_derivation is None for k in descriptor.keys)
         if no_derivation:
             for k in descriptor.keys:
                 if k.is_extended:
@@ -272,13 +491,38 @@ class Wallet:
                     k.allowed_derivation = AllowedDerivation.default()
         return cls(descriptor, path)
 
+    @staticmethod
+    def load_record(fname, keystore):
+        """Loads combined wallet record, returns a tuple (descriptor, meta)"""
+        _, blob = keystore.load_aead(fname)
+        if len(blob) < 4:
+            raise WalletError("Invalid wallet record")
+        (desc_len,) = struct.unpack("<I", blob[:4])
+        if desc_len > len(blob) - 4:
+            raise WalletError("Invalid wallet record")
+        return blob[4 : 4 + desc_len], blob[4 + desc_len :]
+
     @classmethod
     def from_path(cls, path, keystore):
         """Loads wallet from the folder"""
         path = path.rstrip("/")
-        _, desc = keystore.load_aead(path + "/descriptor")
+        desc, meta = None, None
+        if file_exists(path + "/wallet"):
+            try:
+                desc, meta = cls.load_record(path + "/wallet", keystore)
+            except Exception:
+                # fallback to the old records if they are there
+                if not file_exists(path + "/descriptor"):
+                    raise
+        if desc is None:
+            # old format - descriptor and meta in separate files
+            _, desc = keystore.load_aead(path + "/descriptor")
+        # meta record may be newer if the wallet was saved by older firmware
+        if file_exists(path + "/meta"):
+            _, meta = keystore.load_aead(path + "/meta")
+        if meta is None:
+            raise WalletError("Wallet meta is missing")
         w = cls.from_descriptor(desc.decode(), path)
-        _, meta = keystore.load_aead(path + "/meta")
         obj = json.loads(meta.decode())
         if "gaps" in obj:
             w.gaps = obj["gaps"]
@@ -292,8 +536,8 @@ class Wallet:
 
     @property
     def policy(self):
-        if self.descriptor.is_segwit:
-            p = "Nested Segwit, " if self.descriptor.is_wrapped else "Native Segwit, "
+        if self._is_segwit:
+            p = "Nested Segwit, " if self._is_wrapped else "Native Segwit, "
         else:
             p = "Legacy, "
         p += self.descriptor.brief_policy
@@ -301,8 +545,8 @@ class Wallet:
 
     @property
     def full_policy(self):
-        if self.descriptor.is_segwit:
-            p = "Nested Segwit\n" if self.descriptor.is_wrapped else "Native Segwit\n"
+        if self._is_segwit:
+            p = "Nested Segwit\n" if self._is_wrapped else "Native Segwit\n"
         else:
             p = "Legacy\n"
         pp = self.descriptor.full_policy
@@ -314,10 +558,10 @@ class Wallet:
 
     @property
     def is_miniscript(self):
-        return not (self.descriptor.is_basic_multisig or self.descriptor.is_pkh)
+        return self._is_miniscript
 
     def __str__(self):
-        return "%s&%s" % (self.name, self.descriptor)
+        return "%s&%s" % (self.name, self.descriptor_str)
 
     def __repr__(self):
         return "%s(%s)" % (type(self).__name__, str(self))
@@ -1,10 +1,30 @@
 from unittest import TestCase
-from apps.wallets.wallet import Wallet
+from apps.wallets.wallet import Wallet, WalletError
 from bitcoin.descriptor import Key
+from bitcoin import bip32, hashes
+from bitcoin.networks import NETWORKS
+from bitcoin.psbt import DerivationPath
+from bitcoin.transaction import TransactionOutput
+from binascii import unhexlify
+from keystore.ram import RAMKeyStore
 import os, json
 import platform
 
 TEST_DIR = "testdir"
+TPUB = "tpubDCZWxJ6kKqRHep5a2XycxrXRaTES1vs3ysfV7sdv5uhkaEgxBEdVbyQT46m3NcaLJqVNd41TYqDyQfvweLLXGmkxdHRnhxuJPf7BAWMXni2"
+H = 0x80000000
+
+def get_keystore():
+    """Clean up the test folder and create a keystore with id key"""
+    try:
+        platform.delete_recursively(TEST_DIR)
+        os.rmdir(TEST_DIR)
+    except:
+        pass
+    platform.maybe_mkdir(TEST_DIR)
+    ks = RAMKeyStore()
+    ks.idkey = b"1"*32
+    return ks
 
 class WalletsTest(TestCase):
 
@@ -60,3 +80,142 @@ class WalletsTest(TestCase):
                 Key.parse(k)
                 print(k)
 
+    def test_save_load(self):
+        """Test wallet is saved in a single record and loaded back"""
+        ks = get_keystore()
+        desc = "wpkh([8cce63f8/84h/1h/0h]tpubDCZWxJ6kKqRHep5a2XycxrXRaTES1vs3ysfV7sdv5uhkaEgxBEdVbyQT46m3NcaLJqVNd41TYqDyQfvweLLXGmkxdHRnhxuJPf7BAWMXni2/{0,1}/*)"
+        w = Wallet.parse("Test&"+desc, TEST_DIR+"/0")
+        w.gaps = [25, 30]
+        w.save(ks)
+        files = sorted([f[0] for f in os.ilistdir(TEST_DIR+"/0")])
+        # old records are kept for older firmware
+        self.assertEqual(files, ["descriptor", "meta", "wallet"])
+        ww = Wallet.from_path(TEST_DIR+"/0", ks)
+        self.assertEqual(str(ww), str(w))
+        self.assertEqual(ww.gaps, [25, 30])
+        self.assertEqual(ww.fingerprint, w.fingerprint)
+
+    def test_load_old_format(self):
+        """Test wallet saved as separate descriptor and meta files"""
+        ks = get_keystore()
+        desc = "wpkh([8cce63f8/84h/1h/0h]tpubDCZWxJ6kKqRHep5a2XycxrXRaTES1vs3ysfV7sdv5uhkaEgxBEdVbyQT46m3NcaLJqVNd41TYqDyQfvweLLXGmkxdHRnhxuJPf7BAWMXni2/{0,1}/*)"
+        path = TEST_DIR+"/0"
+        platform.maybe_mkdir(path)
+        ks.save_aead(path+"/descriptor", plaintext=desc.encode())
+        meta = json.dumps({"gaps": [21, 22], "name": "Old", "unused_recv": 1})
+        ks.save_aead(path+"/meta", plaintext=meta.encode())
+        w = Wallet.from_path(path, ks)
+        self.assertEqual(str(w), "Old&"+desc)
+        self.assertEqual(w.gaps, [21, 22])
+        # saving adds the new record and keeps the old ones
+        w.gaps = [40, 22]
+        w.save(ks)
+        files = sorted([f[0] for f in os.ilistdir(path)])
+        self.assertEqual(files, ["descriptor", "meta", "wallet"])
+        ww = Wallet.from_path(path, ks)
+        self.assertEqual(ww.gaps, [40, 22])
+
+    def test_meta_record(self):
+        """Test old meta record follows every save and wins on load"""
+        ks = get_keystore()
+        desc = "wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB
+        path = TEST_DIR+"/0"
+        w = Wallet.parse("Test&"+desc, path)
+        w.save(ks)
+        w.gaps = [35, 27]
+        w.unused_recv = 15
+        w.save(ks)
+        _, meta = ks.load_aead(path+"/meta")
+        obj = json.loads(meta.decode())
+        self.assertEqual(obj["gaps"], [35, 27])
+        self.assertEqual(obj["unused_recv"], 15)
+        # older firmware updates only the meta record
+        obj = {"gaps": [50, 30], "name": "Renamed", "unused_recv": 30}
+        ks.save_aead(path+"/meta", plaintext=json.dumps(obj).encode())
+        ww = Wallet.from_path(path, ks)
+        self.assertEqual(ww.name, "Renamed")
+        self.assertEqual(ww.gaps, [50, 30])
+        self.assertEqual(ww.unused_recv, 30)
+
+    def test_get_addresses(self):
+        """Test batch of addresses matches addresses derived one by one"""
+        desc = "wpkh([8cce63f8/84h/1h/0h]tpubDCZWxJ6kKqRHep5a2XycxrXRaTES1vs3ysfV7sdv5uhkaEgxBEdVbyQT46m3NcaLJqVNd41TYqDyQfvweLLXGmkxdHRnhxuJPf7BAWMXni2/{0,1}/*)"
+        w = Wallet.parse(desc)
+        for branch in range(2):
+            addresses, gap = w.get_addresses(3, 5, "test", branch_index=branch)
+            self.assertEqual(len(addresses), 5)
+            self.assertEqual(gap, w.gaps[branch])
+            for i, addr in enumerate(addresses):
+                a, _ = w.get_address(3 + i, "test", branch_index=branch)
+                self.assertEqual(a, addr)
+        with self.assertRaises(WalletError):
+            w.get_addresses(0x7FFFFFFF, 2, "test")
+        # branch is checked even for an empty window
+        for branch in [-1, 5]:
+            with self.assertRaises(WalletError):
+                w.get_addresses(0, 0, "test", branch_index=branch)
+
+    def test_branch_addresses(self):
+        """Test wallet addresses match the ones derived from the descriptor"""
+        descriptors = [
+            "wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB,
+            "sh(wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*))" % TPUB,
+            "pkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB,
+            "wpkh([8cce63f8/84h/1h/0h]%s/*)" % TPUB,
+            "wsh(sortedmulti(1,[8cce63f8/84h/1h/0h]%s/{0,1}/*))" % TPUB,
+        ]
+        for desc in descriptors:
+            w = Wallet.parse(desc)
+            for branch in range(w.descriptor.num_branches):
+                addresses, _ = w.get_addresses(0, 18, "test", branch_index=branch)
+                for idx in [0, 1, 17]:
+                    sc = w.descriptor.derive(idx, branch_index=branch).script_pubkey()
+                    self.assertEqual(w.script_pubkey([branch, idx])[0], sc)
+                    addr = sc.address(NETWORKS["test"])
+                    self.assertEqual(w.get_address(idx, "test", branch_index=branch)[0], addr)
+                    self.assertEqual(addresses[idx], addr)
+
+    def check_owns(self, w, fingerprint, derivation, rest):
+        """Checks derivation and ownership of the output derived with rest"""
+        pub = bip32.HDKey.from_base58(TPUB).derive(rest).key
+        ders = {pub: DerivationPath(fingerprint, derivation)}
+        sc, _ = w.script_pubkey(rest)
+        tx_out = TransactionOutput(1000, sc)
+        return w.get_derivation(ders), w.owns(tx_out, ders)
+
+    def test_owns_full_path(self):
+        """Test derivation with key origin is detected"""
+        w = Wallet.parse("wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB)
+        der, owns = self.check_owns(w, unhexlify("8cce63f8"), [84+H, 1+H, H, 1, 7], [1, 7])
+        self.assertEqual(tuple(der), (1, 7))
+        self.assertTrue(owns)
+
+    def test_owns_short_path(self):
+        """Test derivation relative to the xpub without origin is detected"""
+        w = Wallet.parse("wpkh(%s/{0,1}/*)" % TPUB)
+        fingerprint = hashes.hash160(bip32.HDKey.from_base58(TPUB).key.sec())[:4]
+        der, owns = self.check_owns(w, fingerprint, [0, 3], [0, 3])
+        self.assertEqual(tuple(der), (0, 3))
+        self.assertTrue(owns)
+
+    def test_owns_foreign_fingerprint(self):
+        """Test derivation with unknown fingerprint is rejected"""
+        w = Wallet.parse("wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB)
+        der, owns = self.check_owns(w, unhexlify("deadbeef"), [84+H, 1+H, H, 1, 7], [1, 7])
+        self.assertEqual(der, None)
+        self.assertFalse(owns)
+
+    def test_broken_record(self):
+        """Test wallet is loaded from old records if combined record is broken"""
+        ks = get_keystore()
+        desc = "wpkh([8cce63f8/84h/1h/0h]%s/{0,1}/*)" % TPUB
+        path = TEST_DIR+"/0"
+        w = Wallet.parse("Test&"+desc, path)
+        w.gaps = [33, 21]
+        w.save(ks)
+        # truncated record
+        with open(path+"/wallet", "wb") as f:
+            f.write(b"123")
+        ww = Wallet.from_path(path, ks)
+        self.assertEqual(str(ww), str(w))
+        self.assertEqual(ww.gaps, [33, 21])